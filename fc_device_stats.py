@@ -8,14 +8,38 @@ environment.
 """
 
 import argparse
-import os
+import array
+import asyncio
+import csv
+import functools
+import gzip
+import io
+import ipaddress
+import shlex
 import sys
-import time
 from argparse import RawDescriptionHelpFormatter
 
+import asyncssh
+import numpy as np
 import pandas as pd
 import yaml
-from paramiko import SSHClient
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+STATUS_CATEGORIES = ["Down", "Up"]
+STATUS_CHANGE_CATEGORIES = ["No Change", "Changed"]
+
+# Most FC's to connect to and read from at once
+MAX_CONCURRENT_FETCHES = 32
+
+# Prefix of an IPv4 address mapped into IPv6
+IPV4_MAPPED_PREFIX = b"\x00" * 10 + b"\xff\xff"
+
+# Most DataFrame rows to print, the rest are elided
+MAX_PRINT_ROWS = 200
 
 
 class AbortScriptException(Exception):
@@ -43,28 +67,106 @@ def parse_args():
     return parser.parse_args()
 
 
-def print_banner(description):
+def read_device_stats(data):
+    """Pull the Exporter Address and Current NetFlow bps columns from a TSV.
+
+    Column positions are found once from the header, then rows are streamed
+    with the csv module, no DataFrame is built. Rows that are short or have a
+    non integer bps are skipped and counted.
     """
-    Display a bannerized print.
+    rows = csv.reader(io.StringIO(data.decode()), delimiter="\t")
+    header = next(rows, [])
+    addr_col = header.index("Exporter Address")
+    bps_col = header.index("Current NetFlow bps")
+
+    addrs = []
+    bps = array.array("q")
+    bad_rows = 0
+    for row in rows:
+        if not row:
+            continue
+        try:
+            row_addr = row[addr_col]
+            row_bps = int(row[bps_col])
+        except (IndexError, ValueError):
+            bad_rows += 1
+            continue
+        addrs.append(row_addr)
+        bps.append(row_bps)
+
+    return addrs, np.frombuffer(bps, dtype=np.int64), bad_rows
+
+
+def ip_to_key(addrs):
+    """Pack IP address strings into an array of fixed width 16 byte keys.
+
+    IPv4 addresses are mapped into IPv6 (::ffff:a.b.c.d) so both share one key
+    space. Returns the keys and a mask of which addresses parsed, anything that
+    isn't an IP address at all is left out.
+    """
+    packed = bytearray()
+    valid = np.zeros(len(addrs), dtype=bool)
+    for i, addr in enumerate(addrs):
+        try:
+            ip_addr = ipaddress.ip_address(addr)
+        except ValueError:
+            continue
+        if ip_addr.version == 4:
+            packed += IPV4_MAPPED_PREFIX + ip_addr.packed
+        else:
+            packed += ip_addr.packed
+        valid[i] = True
 
-    E.g.     banner("Kubernetes Join")
+    return np.frombuffer(bytes(packed), dtype="S16"), valid
+
+
+def key_to_ip(keys):
+    """Unpack an array of 16 byte keys into IP address strings."""
+    # Slice the raw buffer, indexing S16 items would strip trailing zero bytes
+    packed = keys.tobytes()
+    addrs = []
+    for i in range(0, len(packed), 16):
+        ip_addr = ipaddress.IPv6Address(packed[i : i + 16])
+        addrs.append(str(ip_addr.ipv4_mapped or ip_addr))
+
+    return np.array(addrs, dtype=object)
+
+
+def status_frame(addrs, bps, status, changed=None, date_changed=None):
+    """Build a DataFrame of exporter statuses from the cycle's arrays.
+
+    With a change mask, add the Status_Change column and a Date_Changed column
+    stamped with date_changed on the changed rows.
     """
-    banner = len(description)
-    if banner > 200:
-        banner = 200
+    columns = {
+        "Exporter_Address": key_to_ip(addrs),
+        "Current_NetFlow_bps": bps,
+        "Status": pd.Categorical.from_codes(status, categories=STATUS_CATEGORIES),
+    }
+    if changed is not None:
+        columns["Status_Change"] = pd.Categorical.from_codes(
+            changed.view(np.int8), categories=STATUS_CHANGE_CATEGORIES
+        )
+        columns["Date_Changed"] = np.where(changed, date_changed, np.datetime64("NaT"))
+
+    return pd.DataFrame(columns, copy=False)
+
+
+def print_frame(title, frame):
+    """Print a titled DataFrame, capped at MAX_PRINT_ROWS rows."""
+    sys.stdout.write(f"{title}:\n")
+    frame.to_string(buf=sys.stdout, index=False, max_rows=MAX_PRINT_ROWS)
+    sys.stdout.write("\n")
 
-    # First banner
-    print("\n")
-    for _ in range(banner):
-        print("*", end="")
 
-    # Add description
-    print("\n%s" % description)
+def print_banner(description):
+    """
+    Display a bannerized print.
 
-    # Final banner
-    for _ in range(banner):
-        print("*", end="")
-    print("\n")
+    E.g.     banner("Kubernetes Join")
+    """
+    banner = "*" * min(len(description), 200)
+    sys.stdout.write(f"\n\n{banner}\n{description}\n{banner}\n\n")
 
 
 class Devicestats:
@@ -73,105 +175,245 @@ class Devicestats:
 
     Create a connection with a remote Flow Connector
     Retrieve /lancope/var/sw/today/data/exporter_device_stats.txt
-    SCP output and process data
+    Stream output over SSH and process data
     """
 
-    pd.options.display.max_rows = None
-    pd.options.display.max_columns = None
-    pd.options.display.width = None
-
-    num_ran = 0
+    __slots__ = (
+        "verbose",
+        "_cur_addrs",
+        "_cur_bps",
+        "_prev_addrs",
+        "_prev_status",
+        "_status_buf",
+        "_cycle_addrs",
+        "_cycle_bps",
+        "fc_datafile_path",
+        "to_user_csv",
+        "_ssh_pool",
+        "_csv_fh",
+        "_fetch_limit",
+        "config",
+        "retry",
+        "_fcs",
+    )
 
     def __init__(self, args):
         """Initialize all variables, basic time checking."""
         self.verbose = args.verbose
-        self.total_fc_data_cycle_current = pd.DataFrame()
-        self.total_fc_data_cycle_prev = pd.DataFrame()
+        # Current cycle's sorted 16 byte address keys and summed bps, and the
+        # previous cycle's address keys and status codes
+        self._cur_addrs = np.empty(0, dtype="S16")
+        self._cur_bps = np.empty(0, dtype=np.int64)
+        self._prev_addrs = np.empty(0, dtype="S16")
+        self._prev_status = np.empty(0, dtype=np.int8)
+        # Scratch buffer for the up/down mask, reused across cycles
+        self._status_buf = np.empty(0, dtype=bool)
+        self._cycle_addrs = []
+        self._cycle_bps = []
         self.fc_datafile_path = "/lancope/var/sw/today/data/exporter_device_stats.txt"
         self.to_user_csv = "persistent_device_stats.csv"
 
+        # SSH connections to the FC's, reused across cycles
+        self._ssh_pool = {}
+        # Persistent CSV, opened on the first status change
+        self._csv_fh = None
+        # Bounds concurrent FC fetches, created by data_runner
+        self._fetch_limit = None
+
         # Get the config
-        with open(args.config, "r") as stream:
-            try:
-                self.config = yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                print(exc)
+        try:
+            with open(args.config, "r") as stream:
+                self.config = yaml.load(stream, Loader=SafeLoader)
+        except yaml.YAMLError as exc:
+            print(exc)
 
         if self.verbose:
             for _, obj in self.config.items():
                 for item in obj:
                     print(f"Config Item: {item}")
 
-        # Pull in the retry from config
-        self.retry = self.config["Admin"]["retry_interval"]
+        # Pull in the retry and FC's from config once
+        self.retry = int(self.config["Admin"]["retry_interval"])
         print(f"Retry Interval: {self.retry}")
+        self._fcs = tuple(
+            (fc["fc_ip"], fc["fc_username"], fc["fc_password"]) for fc in self.config.get("fcs", [])
+        )
 
-    def data_runner(self):
+    async def data_runner(self):
         """Runner that repeatedly retrieves FC data and processes it."""
-        while True:
-            for flow_collector in self.config["fcs"]:
-                # print("Getting data set...")
-                new_fc_data = self.get_fc_file(
-                    flow_collector["fc_ip"],
-                    flow_collector["fc_username"],
-                    flow_collector["fc_password"],
-                )
-                self.combine_fc_data(new_fc_data)
-
-            # Process all the data collected from FC's
-            if self.verbose:
-                print(f"Combined Data:\n{self.total_fc_data_cycle_current}")
-            self.process_data()
-
-            # Wait retry_interval
-            time.sleep(self.retry)
+        get_fc_file = self.get_fc_file
+        combine_fc_data = self.combine_fc_data
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        # Created here so it belongs to the running event loop
+        self._fetch_limit = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+        # Fetch or warm up tasks in flight, cancelled before the pool is closed
+        tasks = []
+        try:
+            while True:
+                next_tick += self.retry
+
+                # Fetch from all FC's concurrently, a cycle only waits on the slowest
+                tasks = [
+                    asyncio.create_task(get_fc_file(*flow_collector))
+                    for flow_collector in self._fcs
+                ]
+                fc_files = await asyncio.gather(*tasks)
+                for fc_addrs, fc_bps in fc_files:
+                    combine_fc_data(fc_addrs, fc_bps)
+                self.aggregate_fc_data()
+
+                # Process all the data collected from FC's
+                self.process_data()
+
+                # Wait out the rest of retry_interval, so cycles don't drift by
+                # the time spent working, and reconnect dropped FC's meanwhile
+                warm = asyncio.create_task(self._warm_connections())
+                tasks = [warm]
+                delay = next_tick - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    # Overran the interval, restart the schedule from now rather
+                    # than running back to back cycles to catch up
+                    next_tick = loop.time()
+                await warm
+        finally:
+            # If one fetch failed the others are still running, stop them so
+            # none reconnects into the pool after it is closed
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.close()
+
+    async def _warm_connections(self):
+        """Make sure every FC has a pooled connection for the next cycle."""
+        # Failures are left for the next fetch to raise
+        await asyncio.gather(
+            *(self._warm_connection(*flow_collector) for flow_collector in self._fcs),
+            return_exceptions=True,
+        )
 
-    def get_fc_file(self, fc_ip, fc_username, fc_password):
+    async def _warm_connection(self, fc_ip, fc_username, fc_password):
+        """Connect to one FC if it isn't pooled, within the fetch limit."""
+        async with self._fetch_limit:
+            await self.get_fc_connection(fc_ip, fc_username, fc_password)
+
+    async def get_fc_connection(self, fc_ip, fc_username, fc_password):
+        """Return the pooled SSH connection to a Flow Collector, connect if needed."""
+        conn = self._ssh_pool.get(fc_ip)
+        if conn is None:
+            print(f"\nSSH connect to Flow Collector: {fc_ip}")
+            # Password auth only, no key files or agent
+            conn = await asyncssh.connect(
+                fc_ip,
+                username=fc_username,
+                password=fc_password,
+                client_keys=None,
+                keepalive_interval=30,
+            )
+            self._ssh_pool[fc_ip] = conn
+
+            # Drop it from the pool once it closes, e.g. a keepalive timeout or
+            # the FC hanging up, so the next warm up or fetch reconnects
+            asyncio.ensure_future(conn.wait_closed()).add_done_callback(
+                functools.partial(self._evict_connection, fc_ip, conn)
+            )
+
+        return conn
+
+    def _evict_connection(self, fc_ip, conn, _closed=None):
+        """Remove a connection from the pool if it is still the pooled one."""
+        if self._ssh_pool.get(fc_ip) is conn:
+            del self._ssh_pool[fc_ip]
+
+    async def get_fc_file(self, fc_ip, fc_username, fc_password):
         """
-        Connect to the Flow Connector scp the file:
-        '/lancope/var/sw/today/data/exporter_device_stats.txt' to /tmp.
+        Connect to the Flow Connector and read the file:
+        '/lancope/var/sw/today/data/exporter_device_stats.txt' into memory.
         """
+        async with self._fetch_limit:
+            for last_attempt in (False, True):
+                conn = await self.get_fc_connection(fc_ip, fc_username, fc_password)
+                try:
+                    # Compress it on the FC and stream it over an exec channel,
+                    # the text shrinks several times over on the wire
+                    result = await conn.run(
+                        f"gzip -c {shlex.quote(self.fc_datafile_path)}", encoding=None, check=True
+                    )
+                    break
+                except asyncssh.ProcessError as exc:
+                    # The remote command failed, not the connection, keep it
+                    print(
+                        f"Reading {self.fc_datafile_path} on Flow Collector {fc_ip} failed, "
+                        f"gzip exit status {exc.exit_status}"
+                    )
+                    raise
+                except (asyncssh.Error, OSError):
+                    # Drop the broken connection, retry once on a fresh one
+                    self._evict_connection(fc_ip, conn)
+                    conn.close()
+                    if last_attempt:
+                        raise
+
+        # Outside the retry, a bad gzip stream is no reason to drop the connection
+        data = gzip.decompress(result.stdout)
+        fc_addrs, fc_bps, bad_rows = read_device_stats(data)
+        if bad_rows:
+            print(f"Skipped {bad_rows} malformed rows from Flow Collector {fc_ip}")
 
-        print(f"\nSSH connect to Flow Collector: {fc_ip}")
-        ssh = SSHClient()
-        ssh.load_system_host_keys()
-        ssh.connect(
-            fc_ip,
-            username=fc_username,
-            password=fc_password,
-            look_for_keys=False,
-            allow_agent=False,
-        )
-
-        sftp = ssh.open_sftp()
-        with sftp.open(self.fc_datafile_path) as tsv:
-            current_device = pd.read_csv(tsv, sep="\t")
-
-        print("File successfully retrieved and read...")
-        # Replace spaces with underscores in column names
-        current_device.columns = current_device.columns.str.replace(" ", "_")
-
-        # Add in the FC IP, this is useful for debugging
-        current_device["FC_IP"] = fc_ip
+        if self.verbose:
+            print("File successfully retrieved and read...")
+            current_device = pd.DataFrame(
+                {"Exporter_Address": fc_addrs, "Current_NetFlow_bps": fc_bps}
+            )
+            print_frame(f"New Flow Collector Data from {fc_ip}", current_device)
+
+        fc_keys, valid = ip_to_key(fc_addrs)
+        if not valid.all():
+            skipped = [addr for addr, ok in zip(fc_addrs, valid) if not ok]
+            print(f"Skipping invalid Exporter Addresses from Flow Collector {fc_ip}: {skipped}")
+            fc_bps = fc_bps[valid]
+
+        return fc_keys, fc_bps
+
+    async def close(self):
+        """Close all pooled SSH connections and the persistent CSV file."""
+        # Swap the pool out first, in-flight fetches may still evict from it
+        ssh_pool, self._ssh_pool = self._ssh_pool, {}
+        for conn in ssh_pool.values():
+            conn.close()
+            await conn.wait_closed()
+
+        if self._csv_fh is not None:
+            self._csv_fh.close()
+            self._csv_fh = None
+
+    def combine_fc_data(self, fc_addrs, fc_bps):
+        """Buffer one Flow Collector's data until the cycle is aggregated."""
 
-        return current_device
+        print("Adding file to aggregated FC data...")
 
-    def combine_fc_data(self, new_fc_data):
-        """Combine Flow Collector data from one cycle into a pandas Series."""
+        self._cycle_addrs.append(fc_addrs)
+        self._cycle_bps.append(fc_bps)
 
-        print("Adding file to aggregated FC data...")
+    def aggregate_fc_data(self):
+        """Sum the buffered FC data for one cycle per Exporter Address.
 
-        # Columns we are interested in
-        fc_data = new_fc_data[["Exporter_Address", "Current_NetFlow_bps", "FC_IP"]]
+        The reduction is done in numpy on 16 byte address keys, process_data
+        only builds DataFrames from the result for output.
+        """
+        all_addrs = np.concatenate(self._cycle_addrs)
+        all_bps = np.concatenate(self._cycle_bps)
 
-        if self.verbose:
-            print(f"New Flow Collector Data:\n{fc_data}")
+        addrs, inverse = np.unique(all_addrs, return_inverse=True)
+        bps = np.zeros(len(addrs), dtype=np.int64)
+        np.add.at(bps, inverse, all_bps)
 
-        self.total_fc_data_cycle_current = (
-            pd.concat([self.total_fc_data_cycle_current, fc_data])
-            .groupby(["Exporter_Address"], as_index=False)["Current_NetFlow_bps"]
-            .sum()
-        ).sort_values("Exporter_Address")
+        self._cur_addrs = addrs
+        self._cur_bps = bps
+        self._cycle_addrs = []
+        self._cycle_bps = []
 
     def process_data(self):
         """Compare data sets.
@@ -181,49 +423,86 @@ class Devicestats:
         """
         print("\nGathered and cleaned all FCs data, lets process it...")
 
-        # Add new column with a status up or down based on the BPS on the FC
+        # Work out an up or down status based on the BPS on the FC
         print("Adding Status based on Current Netflow BPS...\n")
-        self.total_fc_data_cycle_current["Status"] = (
-            self.total_fc_data_cycle_current.Current_NetFlow_bps > 0
-        ).map({True: "Up", False: "Down"})
+        cur_addrs = self._cur_addrs
+        bps = self._cur_bps
+        if self._status_buf.size < len(bps):
+            self._status_buf = np.empty(len(bps), dtype=bool)
+        cur_status = np.greater(bps, 0, out=self._status_buf[: len(bps)]).view(np.int8)
 
         # Display old and current data
         if self.verbose:
-            if self.total_fc_data_cycle_prev.empty:
+            if not self._prev_addrs.size:
                 print("No previous data yet")
             else:
-                print(f"Previous data:\n{self.total_fc_data_cycle_prev}")
+                prev_fc_data = pd.DataFrame(
+                    {
+                        "Exporter_Address": key_to_ip(self._prev_addrs),
+                        "Status": pd.Categorical.from_codes(
+                            self._prev_status, categories=STATUS_CATEGORIES
+                        ),
+                    }
+                )
+                print_frame("Previous data", prev_fc_data)
 
-            print(f"Latest data:\n{self.total_fc_data_cycle_current}")
+            print_frame("Latest data", status_frame(cur_addrs, bps, cur_status))
+
+        if self._prev_addrs.size:
+            # Compare latest and previous data and point out any changes, both
+            # sides are sorted by address so no pandas alignment is needed
+            if np.array_equal(cur_addrs, self._prev_addrs):
+                changed = cur_status != self._prev_status
+            else:
+                # Exporters came or went, anything new counts as changed
+                idx = np.searchsorted(self._prev_addrs, cur_addrs).clip(
+                    max=len(self._prev_addrs) - 1
+                )
+                changed = (self._prev_addrs[idx] != cur_addrs) | (
+                    self._prev_status[idx] != cur_status
+                )
 
-        if not self.total_fc_data_cycle_prev.empty:
-            # Compare latest and previous data and point out any changes
-            comp_fc_data_1_cycle = self.total_fc_data_cycle_current
-            comp_fc_data_1_cycle["Status_Change"] = (
-                comp_fc_data_1_cycle["Status"] != self.total_fc_data_cycle_prev["Status"]
-            ).map({True: "Changed", False: "No Change"})
+            # One datestamp per cycle, so printed and saved changes agree
+            date_changed = pd.Timestamp.now().to_datetime64()
 
-            # Add a datestamp for changed data
-            comp_fc_data_1_cycle["Date_Changed"] = (
-                comp_fc_data_1_cycle["Status_Change"] == "Changed"
-            ).map({True: pd.to_datetime("today"), False: "N/A"})
+            if self.verbose:
+                print_frame(
+                    "Comparison between current and previous data",
+                    status_frame(cur_addrs, bps, cur_status, changed, date_changed),
+                )
 
-            print(f"Comparison between current and previous data:\n{comp_fc_data_1_cycle}")
+            # Where an interface status has changed, report and save to
+            # persistent file, only these rows are turned back into a frame
+            if changed.any():
+                changed_fc_data = status_frame(
+                    cur_addrs[changed],
+                    bps[changed],
+                    cur_status[changed],
+                    changed[changed],
+                    date_changed,
+                )
+                print_frame("Status changes", changed_fc_data)
+                self.persist_data(changed_fc_data)
 
-            # Where an interface status has changed, save to persistent file
-            comp_fc_data_1_cycle.loc[comp_fc_data_1_cycle["Status_Change"] == "Changed"].set_index(
-                "Exporter_Address"
-            ).to_csv(self.to_user_csv, mode="a+", header=not os.path.isfile(self.to_user_csv))
+        # Save latest statuses as the new previous
+        self._prev_addrs = cur_addrs
+        # Copied out, the status buffer is overwritten next cycle
+        self._prev_status = cur_status.copy()
 
-        else:
-            print("Initial data:")
-            print(self.total_fc_data_cycle_current)
+    def persist_data(self, changed_fc_data):
+        """Append changed interface statuses to the persistent CSV file.
 
-        # Save latest data to new previous
-        self.total_fc_data_cycle_prev = self.total_fc_data_cycle_current
+        The file is opened once and kept open across cycles, each cycle's rows
+        go out in a single buffered write.
+        """
+        if self._csv_fh is None:
+            self._csv_fh = open(self.to_user_csv, "a", buffering=1 << 20)
 
-        # Reset for next loop
-        self.total_fc_data_cycle_current = pd.DataFrame()
+        # Append mode starts at the end, so an empty file still needs a header
+        changed_fc_data.set_index("Exporter_Address").to_csv(
+            self._csv_fh, header=self._csv_fh.tell() == 0
+        )
+        self._csv_fh.flush()
 
 
 def main():
@@ -234,7 +513,7 @@ def main():
     try:
         parse = Devicestats(args)
 
-        parse.data_runner()
+        asyncio.run(parse.data_runner())
 
     except Exception:
         print("Exception caught:")